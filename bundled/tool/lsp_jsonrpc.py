@@ -14,6 +14,8 @@ import uuid
 from concurrent.futures import ThreadPoolExecutor
 from typing import BinaryIO, Dict, Optional, Sequence, Union
 
+import lsp_utils as utils
+
 CONTENT_LENGTH = "Content-Length: "
 RUNNER_SCRIPT = str(pathlib.Path(__file__).parent / "lsp_runner.py")
 
@@ -144,6 +146,8 @@ class ProcessManager:
             cwd=cwd,
             stdout=subprocess.PIPE,
             stdin=subprocess.PIPE,
+            # Larger pipes mean fewer kernel round trips for big sources
+            **utils.PIPE_KWARGS,
         )
         self._processes[workspace] = proc
         self._rpc[workspace] = create_json_rpc(proc.stdout, proc.stdin)
@@ -202,51 +206,97 @@ class RpcRunResult:
         self.exception: Optional[str] = exception
 
 
-# pylint: disable=too-many-arguments
-def run_over_json_rpc(
+def _result_from_reply(data: Union[dict, None], msg: dict) -> RpcRunResult:
+    if data is None:
+        return RpcRunResult(
+            "", f"Invalid result for request: {json.dumps(msg, indent=4)}"
+        )
+
+    result = data["result"] if "result" in data else ""
+    if "error" in data:
+        error = data["error"]
+
+        if data.get("exception", False):
+            return RpcRunResult(result, "", error)
+        return RpcRunResult(result, error)
+
+    return RpcRunResult(result, "")
+
+
+def run_over_json_rpc_many(
     workspace: str,
     interpreter: Sequence[str],
     module: str,
-    argv: Sequence[str],
-    use_stdin: bool,
+    requests: Sequence[dict],
     cwd: str,
-    source: str = None,
-) -> RpcRunResult:
-    """Uses JSON-RPC to execute a command."""
+) -> Sequence[RpcRunResult]:
+    """Pipelines several commands over one JSON-RPC connection.
+
+    All request frames are written before any reply is read, so the
+    pipe round trip is paid once per batch rather than once per
+    command. Each request is a dict with `argv`, `useStdin` and
+    optionally `source`; results come back in request order.
+    """
     rpc: Union[JsonRpc, None] = get_or_start_json_rpc(workspace, interpreter, cwd)
     if not rpc:
         raise Exception("Failed to run over JSON-RPC.")
 
-    msg_id = str(uuid.uuid4())
-    msg = {
-        "id": msg_id,
-        "method": "run",
-        "module": module,
-        "argv": argv,
-        "useStdin": use_stdin,
-        "cwd": cwd,
-    }
-    if source:
-        msg["source"] = source
+    msgs = []
+    for request in requests:
+        msg = {
+            "id": str(uuid.uuid4()),
+            "method": "run",
+            "module": module,
+            "argv": request["argv"],
+            "useStdin": request["useStdin"],
+            "cwd": cwd,
+        }
+        if request.get("source"):
+            msg["source"] = request["source"]
+
+        msgs.append(msg)
+
+    def _send_all():
+        with contextlib.suppress(Exception):
+            for msg in msgs:
+                rpc.send_data(msg)
 
-    rpc.send_data(msg)
+    # Write the frames from their own thread while replies are drained
+    # here: the runner starts answering before the whole batch is
+    # written, and a large batch can't deadlock with both pipes full.
+    # If the writer dies the reader sees EOF and raises.
+    writer = threading.Thread(target=_send_all, daemon=True)
+    writer.start()
 
-    data = rpc.receive_data()
+    replies = {}
+    for _ in msgs:
+        data = rpc.receive_data()
+        replies[data.get("id")] = data
 
-    if data["id"] != msg_id:
-        return RpcRunResult(
-            "", f"Invalid result for request: {json.dumps(msg, indent=4)}"
-        )
+    writer.join()
 
-    result = data["result"] if "result" in data else ""
-    if "error" in data:
-        error = data["error"]
+    return [_result_from_reply(replies.get(msg["id"]), msg) for msg in msgs]
 
-        if data.get("exception", False):
-            return RpcRunResult(result, "", error)
-        return RpcRunResult(result, error)
 
-    return RpcRunResult(result, "")
+# pylint: disable=too-many-arguments
+def run_over_json_rpc(
+    workspace: str,
+    interpreter: Sequence[str],
+    module: str,
+    argv: Sequence[str],
+    use_stdin: bool,
+    cwd: str,
+    source: str = None,
+) -> RpcRunResult:
+    """Uses JSON-RPC to execute a command."""
+    results = run_over_json_rpc_many(
+        workspace,
+        interpreter,
+        module,
+        [{"argv": argv, "useStdin": use_stdin, "source": source}],
+        cwd,
+    )
+    return results[0]
 
 
 def shutdown_json_rpc():
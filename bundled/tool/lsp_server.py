@@ -3,18 +3,22 @@
 """Implementation of tool support over LSP."""
 from __future__ import annotations
 
-import copy
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
 import json
 import os
 import pathlib
+import pickle
 import re
 import sys
-import sysconfig
+import threading
+import time
 import traceback
 from typing import Any, Optional, Sequence
 
 from pathlib import Path
-from urllib.parse import urljoin, urlparse, urlunparse
 
 
 # **********************************************************
@@ -54,76 +58,552 @@ MAX_WORKERS = 5
 
 from rec_desc_parser import init_parser, parse, parse_statement, end_of_file, set_deduce_directory
 import rec_desc_parser as parser
+from lark import Token
 from error import ParseError
 from abstract_syntax import *
 import proof_checker
 
+import array
 import asyncio
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 
-set_deduce_directory(".")
-init_parser()
+# The grammar load in init_parser is a noticeable chunk of server
+# startup, so it is deferred off the import path
+_parser_ready = False
+_parser_lock = threading.Lock()
 
 
+def _ensure_parser():
+    """Load the Deduce grammar once, on first use."""
+    global _parser_ready
+
+    if _parser_ready:
+        return
+
+    with _parser_lock:
+        if not _parser_ready:
+            # The grammar ships next to this file; don't rely on the cwd
+            set_deduce_directory(os.fspath(pathlib.Path(__file__).parent))
+            init_parser()
+            _parser_ready = True
+
+
+
+# Interned (type, value) -> small int, so token streams can be compared
+# as int arrays instead of pairwise string compares
+_token_intern = {}
+
+
+def _token_ids(tokens):
+    intern = _token_intern
+    ids = array.array('l')
+    for t in tokens:
+        key = (t.type, t.value)
+        i = intern.get(key)
+        if i is None:
+            i = intern[key] = len(intern)
+        ids.append(i)
+    return ids
+
 
 def find_tok_diff(new, old):
-    for i , (n, o) in enumerate(zip(new, old)):
-        if n != o: return i
-    
-    if len(new) > len(old): 
-        # Addition to the end
-        return len(old)
-    elif len(old)> len(new): 
-        # Deletion from the end
-        return len(new)
-    else: 
-        return -1
-    
+    """Two-ended diff of token streams.
+
+    Returns (i, new_j, old_j) where old[i:old_j] was replaced by
+    new[i:new_j], or None if the streams are equal. Both streams are
+    interned to int ids and, when numpy is importable from the bundle,
+    compared vectorized; the fallback scans stop at the first
+    difference from either end. Callers that know the edit region
+    (splice_tokens) seek there directly and don't need a diff at all.
+    """
+    new_ids = _token_ids(new)
+    old_ids = _token_ids(old)
+
+    limit = min(len(new), len(old))
+
+    if np is not None:
+        a = np.frombuffer(new_ids, dtype=np.int_)
+        b = np.frombuffer(old_ids, dtype=np.int_)
+
+        neq = np.flatnonzero(a[:limit] != b[:limit])
+        i = int(neq[0]) if neq.size else limit
+
+        if i == limit and len(new) == len(old):
+            return None
+
+        m = limit - i
+        neq = np.flatnonzero(a[len(new)-m:][::-1] != b[len(old)-m:][::-1])
+        j = int(neq[0]) if neq.size else m
+
+        return (i, len(new) - j, len(old) - j)
+
+    if len(new) == len(old) and new_ids == old_ids:
+        return None
+
+    i = 0
+    while i < limit and new_ids[i] == old_ids[i]:
+        i += 1
+
+    j = 0
+    while j < limit - i and new_ids[len(new)-1-j] == old_ids[len(old)-1-j]:
+        j += 1
+
+    return (i, len(new) - j, len(old) - j)
+
+
+def find_source_diff(old : str, new : str):
+    """Find the edited region between two versions of a document.
+
+    Returns (a, b, new_b) where old[a:b] was replaced by new[a:new_b],
+    or None if the sources are identical. Works for any number of
+    coalesced edits by over-approximating them as one region.
+    """
+    if old == new:
+        return None
+
+    # Longest common prefix
+    a = 0
+    limit = min(len(old), len(new))
+    while a < limit and old[a] == new[a]:
+        a += 1
+
+    # Longest common suffix that doesn't overlap the prefix
+    s = 0
+    while s < limit - a and old[len(old)-1-s] == new[len(new)-1-s]:
+        s += 1
+
+    return (a, len(old) - s, len(new) - s)
+
+
+def shift_token(tok, delta, line_delta, col_delta, b_line):
+    """Shift a token's stored positions after an edit earlier in the file.
+
+    Tokens on the same line as the end of the edit also move by col_delta.
+    """
+    if tok.line == b_line:
+        tok.column += col_delta
+    if tok.end_line == b_line:
+        tok.end_column += col_delta
+    tok.line += line_delta
+    tok.end_line += line_delta
+    tok.start_pos += delta
+    tok.end_pos += delta
+
+
+def splice_tokens(old_source : str, old_tokens, new_source : str):
+    """Incrementally relex only the edited region of a document.
+
+    Reuses the tokens before the edit as-is, relexes from the first token
+    touching the edit, and stops as soon as the relexed stream resyncs
+    with the old token stream, shifting the reused tail by the size of
+    the edit. Returns (tokens, change_i) where change_i is the index of
+    the first changed token, or None if the source did not change.
+    """
+    diff = find_source_diff(old_source, new_source)
+    if diff is None:
+        return None
+
+    a, b, new_b = diff
+    delta = len(new_source) - len(old_source)
+
+    # Tokens entirely before the edit are unaffected. A token ending
+    # exactly at the edit could merge with the new text, so drop it too.
+    ti = 0
+    while ti < len(old_tokens) and old_tokens[ti].end_pos < a:
+        ti += 1
+
+    # Relex from the end of the last kept token, so edits in the ignored
+    # gaps between tokens (whitespace, comments) are covered too
+    cut = old_tokens[ti-1].end_pos if ti > 0 else 0
+
+    # Old tokens starting at or after the edit are tail-reuse candidates
+    tail_at = {}
+    for j in range(ti, len(old_tokens)):
+        if old_tokens[j].start_pos >= b:
+            tail_at[old_tokens[j].start_pos] = j
+
+    # Position adjustments for tokens lexed from the cut substring
+    pre_lines = new_source.count('\n', 0, cut)
+    pre_cols = cut - (new_source.rfind('\n', 0, cut) + 1)
+
+    # Position adjustments for the reused tail
+    line_delta = new_source.count('\n', 0, new_b) - old_source.count('\n', 0, b)
+    old_b_line = old_source.count('\n', 0, b) + 1
+    col_delta = (new_b - (new_source.rfind('\n', 0, new_b) + 1)) \
+              - (b - (old_source.rfind('\n', 0, b) + 1))
+
+    new_tokens = old_tokens[:ti]
+    tail_i = None
+
+    for tok in parser.lark_parser.lex(new_source[cut:]):
+        tok.start_pos += cut
+        tok.end_pos += cut
+        if tok.line == 1:
+            tok.column += pre_cols
+        if tok.end_line == 1:
+            tok.end_column += pre_cols
+        tok.line += pre_lines
+        tok.end_line += pre_lines
+
+        # Past the edit, try to resync with the old token stream
+        if tok.start_pos >= new_b:
+            j = tail_at.get(tok.start_pos - delta)
+            if j is not None and old_tokens[j].type == tok.type \
+               and old_tokens[j].value == tok.value:
+                tail_i = j
+                break
+
+        new_tokens.append(tok)
+
+    if tail_i is not None:
+        for j in range(tail_i, len(old_tokens)):
+            shift_token(old_tokens[j], delta, line_delta, col_delta, old_b_line)
+        new_tokens.extend(old_tokens[tail_i:])
+
+    return (new_tokens, ti)
+
+
+# Cache of parsed statements, so statements that re-parse to an identical
+# AST after an edit are reused instead of parsed again
+STMT_MEMO_MAX = 1024
+stmt_memo = {}
+
+
+def memo_key(tok):
+    # Positions are part of the key: a statement is only reused when it
+    # hasn't moved, so the Metas inside the cached AST are still valid
+    return (tok.type, tok.value, tok.line, tok.column)
+
+
+def parse_statement_memo(uri : str):
+    """parse_statement, with reuse of cached results.
+
+    A cached statement is reused only when the same document has the
+    same tokens at the same positions, which keeps the cached Metas
+    correct for diagnostics and goto-definition.
+    """
+    toks = parser.token_list
+    start = parser.current_position
+    first = (uri,) + memo_key(toks[start])
+
+    for consumed, stmt in stmt_memo.get(first, ()):
+        n = len(consumed)
+        if start + n <= len(toks) and \
+           all(memo_key(toks[start+i]) == consumed[i] for i in range(n)):
+            parser.current_position = start + n
+            return stmt
+
+    stmt = parse_statement()
+    consumed = tuple(memo_key(t) for t in toks[start:parser.current_position])
+
+    if len(stmt_memo) >= STMT_MEMO_MAX:
+        stmt_memo.clear()
+    stmt_memo.setdefault(first, []).append((consumed, stmt))
+
+    return stmt
+
+
+def format_symbol(tag, node):
+    """Render the display string for a symbol.
+
+    Most parsed symbols are never hovered, so the parse loop stores a
+    (tag, ast) pair and this only runs on first access. Tags instead of
+    closures keep the entries picklable for the disk cache.
+    """
+    if tag == 'str':
+        return str(node)
+    if tag == 'pretty':
+        return node.pretty_print(0)
+    # 'union': the union and each of its constructors display the same
+    return node.name + "{\n\t" \
+        + "\n\t".join([str(c) for c in node.alternatives]) + "\n}"
+
 
 class DeduceItem():
-    """Items in the index"""
+    """View of one entry in a `DocIndex`.
 
-    def __init__(self, loc : Meta, ty, str, comp_ty : lsp.CompletionItemKind, ast_node):
-        self.loc = loc
-        self.ty = ty
-        self.str = str
-        self.completion = comp_ty
-        self.ast = ast_node
+    The index stores its entries in parallel arrays; this is a cheap
+    handle over one slot, materialized only for results actually used.
+    """
+    __slots__ = ('_index', '_i')
+
+    def __init__(self, index, i : int):
+        self._index = index
+        self._i = i
+
+    @property
+    def name(self):
+        return self._index.names[self._i]
+
+    @property
+    def loc(self) -> Meta:
+        return self._index.locs[self._i]
+
+    @property
+    def ty(self):
+        return self._index.tys[self._i]
+
+    @property
+    def str(self):
+        v = self._index.strs[self._i]
+        if not isinstance(v, str):
+            if v[0] == 'union':
+                v = self._index.union_str(v[1])
+            else:
+                v = format_symbol(*v)
+            self._index.strs[self._i] = v
+        return v
+
+    @property
+    def completion(self) -> lsp.CompletionItemKind:
+        return lsp.CompletionItemKind(self._index.kinds[self._i])
+
+    @property
+    def ast(self):
+        return self._index.asts[self._i]
+
+
+class TrieNode():
+    """Node in the suffix trie backing `DocIndex.search`."""
+    __slots__ = ('children', 'leaves')
+
+    def __init__(self):
+        # Deduce identifiers can contain unicode operators, so children
+        # are keyed by character rather than a fixed ASCII table
+        self.children = {}
+        self.leaves = []
+
+
+# How many recent search results to keep per document
+SEARCH_CACHE_MAX = 32
+
+# On-disk cache of parsed documents, keyed by source hash, so reopening
+# a workspace skips the cold-start parse of every imported .pf file
+CACHE_DIR = pathlib.Path(
+    os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))) / "deduce-lsp"
+CACHE_MAX_BYTES = 500 * 1024 * 1024
+
+
+def source_cache_path(source : str) -> pathlib.Path:
+    h = hashlib.blake2b(source.encode(), digest_size=16).hexdigest()
+    return CACHE_DIR / (h + ".pkl")
+
+
+def load_doc_cache(source : str):
+    """Restore the index of a previous session for this exact source.
+
+    Returns a DocIndex or None.
+    """
+    path = source_cache_path(source)
+
+    try:
+        with open(path, "rb") as f:
+            doc_index = pickle.load(f)
+        os.utime(path)  # Mark as recently used for eviction
+    except Exception:  # pylint: disable=broad-except
+        return None
+
+    if not isinstance(doc_index, DocIndex) or doc_index.source != source:
+        return None
+
+    return doc_index
+
+
+def save_doc_cache(doc_index):
+    """Persist a parsed document's index for the next session.
+
+    Best effort: the state is rebuildable, so failures (read-only cache
+    dir, unpicklable AST nodes) just skip the cache.
+    """
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        path = source_cache_path(doc_index.source)
+        tmp = path.with_suffix(".tmp")
+        with open(tmp, "wb") as f:
+            pickle.dump(doc_index, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+        trim_doc_cache()
+    except Exception:  # pylint: disable=broad-except
+        pass
+
+
+def trim_doc_cache():
+    """Drop the least-recently-used cache entries over the size cap."""
+    entries = sorted(CACHE_DIR.glob("*.pkl"), key=lambda p: p.stat().st_mtime)
+    total = sum(p.stat().st_size for p in entries)
+
+    for p in entries:
+        if total <= CACHE_MAX_BYTES:
+            break
+        total -= p.stat().st_size
+        p.unlink(missing_ok=True)
 
 
 class DocIndex():
+    """Symbol index for one document, stored struct-of-arrays.
+
+    One Python object with five attributes per symbol added up; entries
+    now live in parallel arrays and `DeduceItem` views are materialized
+    on demand.
+    """
     def __init__(self):
         self.stmts = []
         self.stmt_is = []
-        self.data = {}
-        self.one_grams = {}
-        # self.tokens = {}
-    
-
-    def add(self, k : str, v):
-        for c in k:
-            self.one_grams.setdefault(c, set()).add(k)
-        
-        self.data[k] = v
+        self.name_idx = {}
+        self.names = []
+        self.locs = []
+        self.tys = []
+        self.strs = []
+        self.kinds = array.array('B')
+        self.asts = []
+        self.trie = TrieNode()
+        # Recent search results; adjacent keystrokes extend the query by
+        # one character, so the previous result can be filtered instead
+        # of walking the trie again
+        self._search_cache = collections.OrderedDict()
+        # Shared union renderings, name -> (ast, str). A union and all
+        # of its constructors display the same text, so it is computed
+        # once instead of per slot; the ast identity check invalidates
+        # the entry when the union is reparsed
+        self._union_strs = {}
+        # Source and token stream of the last parse, for incremental relexing
+        self.source = None
+        self.tokens = []
+        # False while a parse of this source is cancelled mid-file, so
+        # the next parse resumes instead of trusting the stmt prefix
+        self.complete = False
+
+
+    def add(self, k : str, loc : Meta, ty, s, kind : lsp.CompletionItemKind, ast):
+        i = self.name_idx.get(k)
+
+        if i is not None:
+            self.locs[i] = loc
+            self.tys[i] = ty
+            self.strs[i] = s
+            self.kinds[i] = int(kind)
+            self.asts[i] = ast
+            return i
+
+        i = len(self.names)
+        self._search_cache.clear()
+        self.names.append(k)
+        self.locs.append(loc)
+        self.tys.append(ty)
+        self.strs.append(s)
+        self.kinds.append(int(kind))
+        self.asts.append(ast)
+
+        # Insert every suffix of k, so a substring query is just a
+        # prefix walk from the root
+        for start in range(len(k)):
+            node = self.trie
+            for c in k[start:]:
+                node = node.children.setdefault(c, TrieNode())
+                # Suffixes of k are inserted back to back, so checking
+                # the last leaf is enough to avoid duplicates
+                if not node.leaves or node.leaves[-1] != i:
+                    node.leaves.append(i)
+
+        # Published last: parsing runs on a worker thread, and hover or
+        # completion handlers on the event loop that see k in name_idx
+        # will dereference slot i in the parallel arrays right away
+        self.name_idx[k] = i
+
+        return i
 
     def search(self, k : str):
-        s : set = self.one_grams.get(k[0], set())
-        for c in k[1:]:
-            s = s.intersection(self.one_grams.get(c, set()))
-        
-        return list(filter(lambda w : w.find(k) != -1, s))
+        """Indices of every symbol containing k as a substring."""
+        cache = self._search_cache
+        res = cache.get(k)
+
+        if res is None:
+            # Never extend from the empty query: its cached result is
+            # [] (the trie root has no leaves), not "every symbol", and
+            # completions ask for "" whenever the cursor follows a
+            # space or punctuation
+            prev = cache.get(k[:-1]) if len(k) > 1 else None
+            if prev is not None:
+                # One-char extension of the last query: filter its
+                # (already small) result instead of walking the trie
+                res = [i for i in prev if k in self.names[i]]
+            else:
+                node = self.trie
+                for c in k:
+                    node = node.children.get(c)
+                    if node is None:
+                        return []
+                res = node.leaves
+
+            cache[k] = res
+            if len(cache) > SEARCH_CACHE_MAX:
+                cache.popitem(last=False)
+        else:
+            cache.move_to_end(k)
+
+        return list(res)
+
+    def union_str(self, node):
+        """Rendering of a union, shared with all of its constructors."""
+        entry = self._union_strs.get(node.name)
+
+        if entry is None or entry[0] is not node:
+            entry = (node, format_symbol('union', node))
+            self._union_strs[node.name] = entry
+
+        return entry[1]
+
+    def at(self, i : int) -> DeduceItem:
+        return DeduceItem(self, i)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # lark's Token.__reduce__ drops the end positions, so serialize
+        # tokens as plain tuples and rebuild them on load
+        state['tokens'] = [(t.type, t.value, t.line, t.column, t.end_line,
+                            t.end_column, t.start_pos, t.end_pos)
+                           for t in self.tokens]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.tokens = [Token(ty, v, line=l, column=c, end_line=el,
+                             end_column=ec, start_pos=sp, end_pos=ep)
+                       for (ty, v, l, c, el, ec, sp, ep) in state['tokens']]
+        # Only cleanly parsed documents are cached, so indexes pickled
+        # before the flag existed are complete by construction
+        self.__dict__.setdefault('complete', True)
 
 
     def __contains__(self, item):
-        return item in self.data
-    
+        return item in self.name_idx
+
     def __getitem__(self, item):
-        return self.data[item]
+        return self.at(self.name_idx[item])
 
 # Nodes where I will sync parsing
 stmt_like = set([Assert, Define, RecFun, Theorem, Import, Print, Union])
 
+# Bounds for the adaptive debounce delay, in seconds
+MIN_PARSE_DELAY = 0.05
+MAX_PARSE_DELAY = 0.4
+# How many recent parse times to average per document
+PARSE_TIME_WINDOW = 5
+
+
+class CancelToken():
+    """Mutable flag for aborting an in-flight parse when a new edit arrives."""
+    __slots__ = ('cancelled',)
+
+    def __init__(self):
+        self.cancelled = False
+
+
 class DeduceLanguageServer(server.LanguageServer):
     """Language Server for Deduce"""
 
@@ -131,32 +611,131 @@ class DeduceLanguageServer(server.LanguageServer):
         super().__init__(*args, **kwargs)
 
         self.index = {}
+        # name -> [(uri, slot)], so hover/goto are a dict lookup instead
+        # of a scan over every open document's index
+        self.global_symbols = {}
         self.diagnostics = {}
         self.pending_tasks = {}
+        self.cancel_tokens = {}
+        # Rolling window of recent parse times per URI, to size the debounce
+        self.parse_times = {}
+        # Hash of each document's source at its last parse, so unchanged
+        # imports aren't descended into again
+        self.source_hashes = {}
+        # Fingerprint of the diagnostics last sent per URI, to skip the
+        # publish round trip when nothing changed
+        self._last_published = {}
+        # Parsing is CPU-bound pure-Python work; run it off the event loop.
+        # A single worker also serializes access to the parser's module
+        # globals, so only one document is ever parsed at a time.
+        self.parse_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def _register_symbol(self, uri : str, name : str, i : int):
+        entries = self.global_symbols.setdefault(name, [])
+        for j, (u, _) in enumerate(entries):
+            if u == uri:
+                entries[j] = (uri, i)
+                break
+        else:
+            entries.append((uri, i))
+
+    def add_symbol(self, doc_index : DocIndex, uri : str, name : str,
+                   loc : Meta, ty, s, kind : lsp.CompletionItemKind, ast):
+        """Add a symbol to a document's index and the global symbol map."""
+        i = doc_index.add(name, loc, ty, s, kind, ast)
+        self._register_symbol(uri, name, i)
+
+    def adopt_index(self, uri : str, doc_index : DocIndex):
+        """Install a restored DocIndex and register its symbols."""
+        self.index[uri] = doc_index
+        self.diagnostics.setdefault(uri, [])
+        for name, i in doc_index.name_idx.items():
+            self._register_symbol(uri, name, i)
+
+    def lookup_symbol(self, name : str, prefer_uri : str = None):
+        """Find a symbol by name, preferring the given document.
+
+        Returns (uri, DeduceItem) or None.
+        """
+        entries = self.global_symbols.get(name)
+        if not entries:
+            return None
+
+        uri, i = entries[0]
+        if prefer_uri is not None:
+            for u, j in entries:
+                if u == prefer_uri:
+                    uri, i = u, j
+                    break
+
+        return (uri, self.index[uri].at(i))
+
+    def publish_diagnostics_if_changed(self, uri : str):
+        """Publish a document's diagnostics, unless they match the last send.
+
+        Most reparses during steady typing produce the same (usually
+        empty) list, so this skips the JSON-RPC round trip and the
+        client-side render churn.
+        """
+        diagnostics = self.diagnostics.get(uri, [])
+        fingerprint = tuple(
+            (d.range.start.line, d.range.start.character, d.message)
+            for d in diagnostics)
+
+        if self._last_published.get(uri) == fingerprint:
+            return
 
-    async def debounce_parse(self, doc : TextDocument):
-        """Debounce function to delay parsing after rapid edits."""
+        self._last_published[uri] = fingerprint
+        self.publish_diagnostics(uri=uri, diagnostics=diagnostics)
+
+    def parse_delay(self, uri : str):
+        """Debounce delay for a document, adapted to its measured parse cost.
+
+        Small files reparse near-instantly, so they shouldn't idle for
+        half a second; big files self-throttle instead of flooding.
+        """
+        window = self.parse_times.get(uri)
+        if not window:
+            return MIN_PARSE_DELAY
+
+        delay = 1.2 * sum(window) / len(window)
+        return min(max(delay, MIN_PARSE_DELAY), MAX_PARSE_DELAY)
+
+    def debounce_parse(self, doc : TextDocument):
+        """Schedule a parse after the edits settle; fire and forget.
+
+        The handler returns immediately, so edit events are processed
+        at arrival rate instead of parse rate. Diagnostics are
+        published from the scheduled task when the parse finishes.
+        """
+
+        PARSE_DELAY = self.parse_delay(doc.uri)
+
+        if doc.uri in self.cancel_tokens:
+            # Tell an already-running parse to stop at the next statement
+            self.cancel_tokens[doc.uri].cancelled = True
 
-        PARSE_DELAY = 0.5  # Adjust as needed
-        
         if doc.uri in self.pending_tasks:
-            self.pending_tasks[doc.uri].cancel()  # Cancel previous task
-            try:
-                await self.pending_tasks[doc.uri]  # Ensure proper cancellation handling
-            except asyncio.CancelledError:
-                pass  # Ignore cancellation exceptions
-            
-    
+            # The single-worker parse pool keeps the old and new parse
+            # from overlapping, so there is no need to await this
+            self.pending_tasks[doc.uri].cancel()
+
+        cancel = CancelToken()
+        self.cancel_tokens[doc.uri] = cancel
+
         async def delayed_parse():
             try:
                 await asyncio.sleep(PARSE_DELAY)  # Wait for more edits
-                self.inc_parse(doc)  # Ensure parsing completes before proceeding
+                t0 = time.perf_counter()
+                await self.inc_parse(doc, cancel)
+                times = self.parse_times.setdefault(
+                    doc.uri, collections.deque(maxlen=PARSE_TIME_WINDOW))
+                times.append(time.perf_counter() - t0)
+                self.publish_diagnostics_if_changed(doc.uri)
             except asyncio.CancelledError:
                 pass  # Silently ignore cancelled tasks
-    
-        task = asyncio.create_task(delayed_parse())
-        self.pending_tasks[doc.uri] = task
-        await task
+
+        self.pending_tasks[doc.uri] = asyncio.create_task(delayed_parse())
 
     # def tok_at_position(self, uri : str, position):
     #     if uri not in self.index:
@@ -169,71 +748,147 @@ class DeduceLanguageServer(server.LanguageServer):
     
     #     return self.index[uri].tokens[p_hash]
 
-    def inc_parse(self, doc : TextDocument):
+    async def inc_parse(self, doc : TextDocument, cancel : CancelToken = None,
+                        _visited : set = None):
+        """Parse a document on the worker thread, then its imports.
+
+        A file imported by several open proofs is only visited once per
+        reparse, and an import is only descended into when its source
+        changed since it was last parsed.
+        """
+        if _visited is None:
+            _visited = set()
+
+        _visited.add(doc.uri)
+
+        # Snapshot the text once: the event loop keeps applying edits to
+        # the live document, and the parse, the index write-back and the
+        # recorded hash must all describe the same version
+        source = doc.source
+
+        # Editors autosave and emit no-op changes; hashing the source is
+        # orders of magnitude cheaper than the re-lex it short-circuits
+        h = hashlib.blake2b(source.encode(), digest_size=16).digest()
+        if self.source_hashes.get(doc.uri) == h and doc.uri in self.index:
+            return self.index[doc.uri].stmts
+
+        loop = asyncio.get_running_loop()
+        stmts, imports = await loop.run_in_executor(
+            self.parse_pool, self._parse_doc, doc, source, h, cancel)
+
+        for i in imports:
+            if i.uri not in _visited:
+                await self.inc_parse(i, cancel, _visited)
+
+        return stmts
+
+    def _import_docs(self, doc : TextDocument, stmts):
+        """Documents imported by stmts, resolved next to doc.
+
+        Derived from the statement list rather than collected during
+        parsing, so restored and incrementally reparsed documents
+        report their imports too — including ones above the edit.
+        """
+        # TODO: Be smarter about what could be included
+        base_path = os.path.dirname(doc.path)
+        imports = []
+
+        for stmt in stmts:
+            match stmt:
+                case Import(meta, name):
+                    for potential_path in (
+                            os.path.join(base_path, name + ".pf"),
+                            os.path.join(base_path, 'lib', name + ".pf")):
+                        if os.path.exists(potential_path):
+                            imports.append(self.workspace.get_text_document(
+                                Path(potential_path).absolute().as_uri()))
+                            break
+                case _:
+                    pass
+
+        return imports
+
+    def _parse_doc(self, doc : TextDocument, source : str, digest : bytes,
+                   cancel : CancelToken = None):
+        """Parse the given snapshot of doc's text.
+
+        `source` and its `digest` are taken by the caller on the event
+        loop; the live doc.source may have moved on by the time the
+        worker runs, and mixing versions would record a hash for text
+        that was never parsed.
+        """
+        _ensure_parser()
+
         # doc_index = {"stmts": [], "stmt_is": []} if doc.uri not in self.index else self.index[doc.uri]
         doc_index = self.index.get(doc.uri, DocIndex())
 
         stmts = doc_index.stmts
         stmt_is = doc_index.stmt_is
 
-        lexed = list(parser.lark_parser.lex(doc.source))
+        if doc_index.source is None:
+            # First parse of this document
+            tokens = list(parser.lark_parser.lex(source))
+            change_i = 0
+        else:
+            spliced = splice_tokens(doc_index.source, doc_index.tokens, source)
+
+            if spliced is None and doc_index.complete:
+                # No text change (e.g. a cache-restored index on open):
+                # still report imports so they get indexed; unchanged
+                # ones cost the caller a hash check each
+                return (stmts, self._import_docs(doc, stmts))
+
+            if spliced is None:
+                # Same text, but the last parse of it was cancelled
+                # mid-file, so only a statement prefix is indexed;
+                # resume after the prefix instead of trusting it
+                tokens, change_i = doc_index.tokens, len(doc_index.tokens)
+            else:
+                tokens, change_i = spliced
+
+        doc_index.source = source
+        doc_index.tokens = tokens
+        doc_index.complete = False
+
+        # Index of the first statement whose tokens reach the change.
+        # stmt_is[i] is the token index just past statement i.
+        stmt_i = 0
+        while stmt_i < len(stmt_is) and stmt_is[stmt_i] <= change_i:
+            stmt_i += 1
+
+        parser.token_list = tokens
+        parser.current_position = stmt_is[stmt_i - 1] if stmt_i > 0 else 0
 
-        change_i = find_tok_diff(lexed, parser.token_list)
-    
-        if change_i < 0: 
-            return
-    
-        # Index of the first changed statement
-        stmt_i = next((i-1 for i, x in enumerate(stmt_is) if x > change_i), 0)
-    
-        parser.token_list = lexed
-        parser.current_position = stmt_is[stmt_i] if stmt_is != [] else 0
-    
         stmts = stmts[:stmt_i]
         stmt_is = stmt_is[:stmt_i]
 
         try:
-            imports = []
             while not end_of_file():
-                stmt = parse_statement()
-                
+                if cancel is not None and cancel.cancelled:
+                    raise asyncio.CancelledError
+
+                stmt = parse_statement_memo(doc.uri)
+
                 stmt_is.append(parser.current_position)
                 stmts.append(stmt)
     
                 match stmt:
-                    case Define(meta, name, ty, body, priv):
-                        doc_index.add(name, DeduceItem(meta, ty, str(stmt), lsp.CompletionItemKind.Variable, stmt))
-                    case RecFun(meta, name, type_params, param_types, return_type, cases, priv):
+                    case Define(meta, name, ty, body):
+                        self.add_symbol(doc_index, doc.uri, name, meta, ty, ('str', stmt), lsp.CompletionItemKind.Variable, stmt)
+                    case RecFun(meta, name, type_params, param_types, return_type, cases):
                         # TODO: I'm being lazy wrt types
-                        doc_index.add(name, DeduceItem(meta, None, stmt.pretty_print(0), lsp.CompletionItemKind.Function, stmt))
-                    case Theorem(meta, name, what, proof, priv):
+                        self.add_symbol(doc_index, doc.uri, name, meta, None, ('pretty', stmt), lsp.CompletionItemKind.Function, stmt)
+                    case Theorem(meta, name, what, proof):
                         # Theorems don't have a type
-                        doc_index.add(name, DeduceItem(meta, None, str(what), lsp.CompletionItemKind.Function, stmt))
-                    case Union(meta, name, typarams, constr_list, priv):
-                        pretty = name + "{\n\t" \
-                        + "\n\t".join([str(c) for c in constr_list]) + "\n}"
-
-                        doc_index.add(name, DeduceItem(meta, None, pretty, lsp.CompletionItemKind.Struct, stmt))
+                        self.add_symbol(doc_index, doc.uri, name, meta, None, ('str', what), lsp.CompletionItemKind.Function, stmt)
+                    case Union(meta, name, typarams, constr_list):
+                        self.add_symbol(doc_index, doc.uri, name, meta, None, ('union', stmt), lsp.CompletionItemKind.Struct, stmt)
                         for c in constr_list:
-                            doc_index.add(c.name, DeduceItem(c.location, None, pretty, lsp.CompletionItemKind.Variable, stmt))
-                    case Import(meta, name):
-                        # TODO: Be smarter about what could be included
-                        base_path = os.path.dirname(doc.path)
-
-                        potential_path = os.path.join(base_path, name + ".pf")
-
-                        if os.path.exists(potential_path):
-                            imports.append(self.workspace.get_text_document(Path(potential_path).absolute().as_uri()))
-                        else:
-                            potential_path = os.path.join(base_path, 'lib', name + ".pf")
-                            if os.path.exists(potential_path):
-                                imports.append(self.workspace.get_text_document(Path(potential_path).absolute().as_uri()))
-                    case _: # Irrelevant statements
+                            self.add_symbol(doc_index, doc.uri, c.name, c.location, None, ('union', stmt), lsp.CompletionItemKind.Variable, stmt)
+                    case _: # Irrelevant statements (imports are
+                            # collected from stmts afterwards)
                         pass
-            
-            for i in imports:
-                self.inc_parse(i)
-            
+
         except ParseError as e:
             self.diagnostics[doc.uri]= [lsp.Diagnostic(
                     message=e.base_message(),
@@ -245,10 +900,27 @@ class DeduceLanguageServer(server.LanguageServer):
                 )]
         else:
             self.diagnostics[doc.uri] = []
-                
-        self.index[doc.uri] = doc_index
+        finally:
+            # The index already holds the new source and tokens, so the
+            # statement list must be written back even when the parse is
+            # cancelled mid-file: the statements parsed so far are
+            # consistent with the new token stream, while the old ones
+            # are not. Diagnostics, the source hash and the disk cache
+            # are left to the parse that runs to completion.
+            doc_index.stmts = stmts
+            doc_index.stmt_is = stmt_is
+            self.index[doc.uri] = doc_index
 
-        return stmts
+        # Reached on completion and on ParseError (which consumes as
+        # far as it can and would just recur), not on cancellation
+        doc_index.complete = True
+        self.source_hashes[doc.uri] = digest
+
+        if not self.diagnostics[doc.uri]:
+            # Only cleanly parsed documents are worth persisting
+            save_doc_cache(doc_index)
+
+        return (stmts, self._import_docs(doc, stmts))
 
 
 
@@ -257,6 +929,10 @@ LSP_SERVER = DeduceLanguageServer(
     name="Deduce Language Server", version="0.0.3", max_workers=MAX_WORKERS
 )
 
+# Argument lists inside (), [] or <>, for signature help
+_SIG_RE = re.compile(r"[([<](([^)],?)*)")
+
+
 @LSP_SERVER.feature(
         lsp.TEXT_DOCUMENT_SIGNATURE_HELP,
         lsp.SignatureHelpOptions(trigger_characters=["(", ")", "[", "]", "<", ">"])
@@ -274,7 +950,7 @@ def signature_help(ls : DeduceLanguageServer, params: lsp.SignatureHelpParams):
 
     # TODO: Better parsing for where the characters are, esp since mixing functions and theorems
     # Also because the theorem could have multiple blocks
-    for m in re.finditer(r"[([<](([^)],?)*)", current_line):
+    for m in _SIG_RE.finditer(current_line):
         if m.start() <= params.position.character and m.end() >=  params.position.character:
             fun_match = m
             fun_i = params.position.character - m.start()
@@ -305,9 +981,9 @@ def signature_help(ls : DeduceLanguageServer, params: lsp.SignatureHelpParams):
 
     fun_sig = fun_name
 
-    for uri in ls.index:
-        if fun_name in ls.index[uri]:
-            fun_sig = ls.index[uri][fun_name].str.split("\n")[0][:-1]
+    found = ls.lookup_symbol(fun_name, doc.uri)
+    if found is not None:
+        fun_sig = found[1].str.split("\n")[0][:-1]
 
     # TODO: Use fun_i to do bold in the markdown help?
     # TODO: Combine both types of complete
@@ -341,11 +1017,14 @@ def completions(ls : DeduceLanguageServer, params: lsp.CompletionParams):
     for uri in ls.index:
         ops = ls.index[uri].search(word)
 
-        for k in ops:
+        for i in ops:
+            item = ls.index[uri].at(i)
+            k = item.name
+
             # TODO: Induction advice, need these things from index
-            if isinstance(ls.index[uri][k].ast, Union) and current_line.startswith("induction"):
-                match ls.index[uri][k].ast:
-                  case Union(loc2, name, typarams, alts, isPrivate):
+            if isinstance(item.ast, Union) and current_line.startswith("induction"):
+                match item.ast:
+                  case Union(loc2, name, typarams, alts):
                     ind_advice = 'induction ' + k + '\n'
 
                     for alt in alts:
@@ -381,8 +1060,8 @@ def completions(ls : DeduceLanguageServer, params: lsp.CompletionParams):
                             )
                     ))
 
-            res.append(lsp.CompletionItem(label=k, 
-                                   kind=ls.index[uri][k].completion))
+            res.append(lsp.CompletionItem(label=k,
+                                   kind=item.completion))
 
     return res
 
@@ -409,34 +1088,58 @@ def hover(ls : DeduceLanguageServer, params: lsp.HoverParams):
     if word == '': return
 
     word_i = 0
-    
-    for m in re.finditer(word, line):
-        if m.start() <= params.position.character and m.end() >=  params.position.character:
-            word_i = m.start()
-
 
-    for k in ls.index:
-        if word in ls.index[k]:
-            return lsp.Hover(
-                contents=lsp.MarkupContent(
-                    kind=lsp.MarkupKind.PlainText,
-                    value=ls.index[k][word].str
-                ),
-                range=lsp.Range(
-                    start=lsp.Position(line=pos.line, character=word_i),
-                    end=lsp.Position(line=pos.line, character=word_i + len(word))
-                )
+    # Plain substring scan; identifiers can contain regex metacharacters
+    i = line.find(word)
+    while i != -1:
+        if i <= params.position.character and i + len(word) >= params.position.character:
+            word_i = i
+            break
+        i = line.find(word, i + 1)
+
+
+    found = ls.lookup_symbol(word, document_uri)
+    if found is not None:
+        return lsp.Hover(
+            contents=lsp.MarkupContent(
+                kind=lsp.MarkupKind.PlainText,
+                value=found[1].str
+            ),
+            range=lsp.Range(
+                start=lsp.Position(line=pos.line, character=word_i),
+                end=lsp.Position(line=pos.line, character=word_i + len(word))
             )
+        )
+
 
+all_ops = (parser.expt_operators | parser.mult_operators | parser.add_operators
+           | parser.compare_operators | parser.equal_operators | parser.iff_operators)
+max_op_len = max(len(o) for o in all_ops)
+
+# Prefix trie over the operator spellings; '$' marks a complete operator
+op_trie = {}
+for _op in all_ops:
+    _node = op_trie
+    for _c in _op:
+        _node = _node.setdefault(_c, {})
+    _node['$'] = _op
 
-all_ops = parser.expt_operators.union(parser.mult_operators).union(parser.add_operators).union(parser.compare_operators).union(parser.equal_operators).union(parser.iff_operators) 
-max_op_len = 3 # Just hardcoding for now
 
 def look_for_op(l, pos):
-    pos = pos-max_op_len + 1
-    for i in range(max_op_len, 0, -1):
-        if l[pos:pos+i] in all_ops:
-            return l[pos:pos+i]
+    """Longest operator in l starting max_op_len-1 characters before pos.
+
+    One walk down the trie instead of a membership test per candidate
+    length, remembering the last complete operator passed through.
+    """
+    node = op_trie
+    best = None
+    for i in range(max(pos - max_op_len + 1, 0), len(l)):
+        node = node.get(l[i])
+        if node is None:
+            break
+        if '$' in node:
+            best = node['$']
+    return best
 
 
 # TODO: Scope
@@ -460,62 +1163,44 @@ def goto_definition(ls: DeduceLanguageServer, params: lsp.DefinitionParams):
             i += 1
 
     # Prioritize the currently open document
-    if doc.uri in ls.index and word in ls.index[doc.uri]:
-        loc : Meta = ls.index[doc.uri][word].loc
+    found = ls.lookup_symbol(word, doc.uri)
+    if found is not None:
+        uri, item = found
+        loc : Meta = item.loc
 
-        return lsp.Location(uri=doc.uri, range=lsp.Range(
+        return lsp.Location(uri=uri, range=lsp.Range(
             start=lsp.Position(line=loc.line-1, character=loc.column - 1),
             end=lsp.Position(line=loc.line-1, character=loc.column - 1)
         ))
-    else:
-        for uri in ls.index:
-            if word in ls.index[uri]:
-                loc : Meta = ls.index[uri][word].loc
-
-                return lsp.Location(uri=uri, range=lsp.Range(
-                    start=lsp.Position(line=loc.line-1, character=loc.column - 1),
-                    end=lsp.Position(line=loc.line-1, character=loc.column - 1)
-                ))
 
 
 
 @LSP_SERVER.feature(lsp.TEXT_DOCUMENT_DID_OPEN)
-async def did_open(ls : DeduceLanguageServer, params: lsp.DidOpenTextDocumentParams):
+def did_open(ls : DeduceLanguageServer, params: lsp.DidOpenTextDocumentParams):
     """Parse each document when it is opened"""
     doc = ls.workspace.get_text_document(params.text_document.uri)
-    await ls.debounce_parse(doc)
 
-    diagnostics = ls.diagnostics[doc.uri]
+    if doc.uri not in ls.index:
+        # Try restoring the parse of a previous session
+        cached = load_doc_cache(doc.source)
+        if cached is not None:
+            ls.adopt_index(doc.uri, cached)
 
-    LSP_SERVER.publish_diagnostics(
-        uri=params.text_document.uri,
-        diagnostics = diagnostics)
+    ls.debounce_parse(doc)
 
 
 @LSP_SERVER.feature(lsp.TEXT_DOCUMENT_DID_CHANGE)
-async def did_save(ls : DeduceLanguageServer, params: lsp.DidChangeTextDocumentParams):
+def did_save(ls : DeduceLanguageServer, params: lsp.DidChangeTextDocumentParams):
     """Parse each document when it is changed"""
     doc = ls.workspace.get_text_document(params.text_document.uri)
-    await ls.debounce_parse(doc)
-
-    diagnostics = ls.diagnostics[doc.uri]
-
-    LSP_SERVER.publish_diagnostics(
-        uri=params.text_document.uri,
-        diagnostics = diagnostics)
+    ls.debounce_parse(doc)
 
 
 @LSP_SERVER.feature(lsp.TEXT_DOCUMENT_DID_SAVE)
-async def did_save(ls : DeduceLanguageServer, params: lsp.DidSaveTextDocumentParams):
+def did_save(ls : DeduceLanguageServer, params: lsp.DidSaveTextDocumentParams):
     """Parse each document when it is saved"""
     doc = ls.workspace.get_text_document(params.text_document.uri)
-    await ls.debounce_parse(doc)
-
-    diagnostics = ls.diagnostics[doc.uri]
-
-    LSP_SERVER.publish_diagnostics(
-        uri=params.text_document.uri,
-        diagnostics = diagnostics)
+    ls.debounce_parse(doc)
 
 
 # **********************************************************
@@ -539,6 +1224,11 @@ TOOL_DISPLAY = "Deduce Language Server"
 # all scenarios.
 TOOL_ARGS = []  # default arguments always passed to your tool.
 
+# Interned argv prefixes, so the dispatch plan builds from constant
+# tuples instead of re-tuplifying the lists above
+_BASE_ARGV = (TOOL_MODULE,)
+_TOOL_ARGS_T = tuple(TOOL_ARGS)
+
 
 # TODO: If your tool is a linter then update this section.
 # Delete "Linting features" section if your tool is NOT a linter.
@@ -738,6 +1428,10 @@ def initialize(params: lsp.InitializeParams) -> None:
         f"Global settings:\r\n{json.dumps(GLOBAL_SETTINGS, indent=4, ensure_ascii=False)}\r\n"
     )
 
+    # Warm the grammar on the parse worker so the first did_open
+    # doesn't pay for it
+    LSP_SERVER.parse_pool.submit(_ensure_parser)
+
 
 @LSP_SERVER.feature(lsp.EXIT)
 def on_exit(_params: Optional[Any] = None) -> None:
@@ -761,24 +1455,52 @@ def _get_global_defaults():
     }
 
 
+class _Settings(dict):
+    """Settings snapshot with a deepcopy fast path.
+
+    The callers in this file no longer deepcopy settings, but anything
+    that still does only needs the three known mutable fields cloned —
+    not the generic reconstruct-every-leaf walk.
+    """
+
+    def __deepcopy__(self, memo):
+        new = _Settings(self)
+        memo[id(self)] = new
+        for key in ("path", "interpreter", "args"):
+            if key in new:
+                new[key] = list(new[key])
+        return new
+
+
+# Resolved settings per document path; settings only change through
+# _update_workspace_settings, which clears this
+_SETTINGS_CACHE = {}
+
+
 def _update_workspace_settings(settings):
+    _SETTINGS_CACHE.clear()
+    # New settings can change what the tool reports for the same source
+    _RESULT_CACHE.clear()
+    utils.is_current_interpreter.cache_clear()
+    utils.is_stdlib_file.cache_clear()
+    reload_env()
     if not settings:
         key = os.getcwd()
-        WORKSPACE_SETTINGS[key] = {
+        WORKSPACE_SETTINGS[key] = _Settings({
             "cwd": key,
             "workspaceFS": key,
             "workspace": uris.from_fs_path(key),
             **_get_global_defaults(),
-        }
+        })
         return
 
     for setting in settings:
         key = uris.to_fs_path(setting["workspace"])
-        WORKSPACE_SETTINGS[key] = {
+        WORKSPACE_SETTINGS[key] = _Settings({
             "cwd": key,
             **setting,
             "workspaceFS": key,
-        }
+        })
 
 
 def _get_settings_by_path(file_path: pathlib.Path):
@@ -809,6 +1531,14 @@ def _get_document_key(document: workspace.Document):
 
 
 def _get_settings_by_document(document: workspace.Document | None):
+    key = document.path if document is not None else None
+    cached = _SETTINGS_CACHE.get(key)
+    if cached is None:
+        cached = _SETTINGS_CACHE[key] = _resolve_settings_for_document(document)
+    return cached
+
+
+def _resolve_settings_for_document(document: workspace.Document | None):
     if document is None or document.path is None:
         return list(WORKSPACE_SETTINGS.values())[0]
 
@@ -816,12 +1546,12 @@ def _get_settings_by_document(document: workspace.Document | None):
     if key is None:
         # This is either a non-workspace file or there is no workspace.
         key = os.fspath(pathlib.Path(document.path).parent)
-        return {
+        return _Settings({
             "cwd": key,
             "workspaceFS": key,
             "workspace": uris.from_fs_path(key),
             **_get_global_defaults(),
-        }
+        })
 
     return WORKSPACE_SETTINGS[str(key)]
 
@@ -829,6 +1559,202 @@ def _get_settings_by_document(document: workspace.Document | None):
 # *****************************************************
 # Internal execution APIs.
 # *****************************************************
+# Reusable sys.path snapshot for in-process runs, refreshed only when
+# sys.path (or the snapshot itself, mutated by the tool) changed
+_sys_path_snapshot = None
+
+
+def _sys_path_guard():
+    """List to install as sys.path while the tool runs in-process.
+
+    The equality check costs a short-circuiting compare; the copy it
+    usually avoids allocates the whole list per call.
+    """
+    global _sys_path_snapshot
+    if _sys_path_snapshot is None or _sys_path_snapshot != sys.path:
+        _sys_path_snapshot = sys.path[:]
+    return _sys_path_snapshot
+
+
+def _run_module_in_process(
+    argv: Sequence[str],
+    use_stdin: bool,
+    cwd: str,
+    source: str = None,
+) -> utils.RunResult:
+    """Run the tool as a module inside this process.
+
+    Fallback for when the persistent runner process cannot be started.
+    Pays the tool's import cost on every call, which is why module runs
+    normally go to the runner instead.
+    """
+    # This is needed to preserve sys.path, in cases where the tool modifies
+    # sys.path and that might not work for this scenario next time around.
+    with utils.substitute_attr(sys, "path", _sys_path_guard()):
+        try:
+            # TODO: `utils.run_module` is equivalent to running `python -m <pytool-module>`.
+            # If your tool supports a programmatic API then replace the function below
+            # with code for your tool. You can also use `utils.run_api` helper, which
+            # handles changing working directories, managing io streams, etc.
+            # Also update `utils.run_module` in `lsp_runner.py`.
+            result = utils.run_module(
+                module=TOOL_MODULE,
+                argv=argv,
+                use_stdin=use_stdin,
+                cwd=cwd,
+                source=source,
+            )
+        except Exception:
+            log_error(traceback.format_exc(chain=True))
+            raise
+    return result
+
+
+# Results of recent tool runs keyed on document content, so unchanged
+# documents (autosave, focus cycling) don't re-run the tool at all
+_RESULT_CACHE = collections.OrderedDict()
+_RESULT_CACHE_MAX = 128
+
+# Whether a document should be skipped, cached per URI: the notebook
+# and stdlib checks don't change for a given document, and the stdlib
+# one walks filesystem paths
+_SKIP_CACHE = {}
+
+
+def _is_notebook_cell(uri) -> bool:
+    # pygls hands us str URIs, but take parsed URI objects too rather
+    # than paying a str() round trip on every check
+    if isinstance(uri, str):
+        return uri.startswith("vscode-notebook-cell:")
+    return getattr(uri, "scheme", None) == "vscode-notebook-cell"
+
+
+def _should_skip_document(document: workspace.Document) -> bool:
+    skip = _SKIP_CACHE.get(document.uri)
+    if skip is None:
+        skip = _SKIP_CACHE[document.uri] = (
+            _is_notebook_cell(document.uri)
+            or utils.is_stdlib_file(document.path)
+        )
+    return skip
+
+
+# UTF-8 encoding of each document's source, CRLF-normalized, cached per
+# version so both costs are paid once per edit instead of once per run
+_ENCODED_SOURCE = {}
+
+
+def _encoded_source(document: workspace.Document) -> bytes:
+    version = document.version
+    cached = _ENCODED_SOURCE.get(document.uri)
+    if cached is not None and version is not None and cached[0] == version:
+        return cached[1]
+
+    source = document.source
+    if "\r\n" in source:
+        source = source.replace("\r\n", "\n")
+    data = source.encode("utf-8")
+
+    if version is not None:
+        _ENCODED_SOURCE[document.uri] = (version, data)
+    return data
+
+
+_DispatchPlan = collections.namedtuple(
+    "_DispatchPlan", "use_path base_argv interpreter code_workspace cwd"
+)
+
+
+def _dispatch_plan(settings) -> _DispatchPlan:
+    """Dispatch decision and argv prefix for a settings snapshot.
+
+    Everything here depends only on the settings, so it is computed
+    once per snapshot and stashed on it, instead of redoing the dict
+    lookups and list concatenations on every keystroke-triggered run.
+    """
+    plan = settings.get("_dispatch_plan")
+    if plan is None:
+        use_path = bool(settings["path"])
+        if use_path:
+            # 'path' setting takes priority over everything.
+            base_argv = (*settings["path"], *_TOOL_ARGS_T, *settings["args"])
+            interpreter = ()
+        else:
+            # Module runs go to the persistent runner process, whether
+            # or not a different interpreter is set: the runner is
+            # spawned once per workspace and re-imports the tool only
+            # once, instead of on every invocation.
+            base_argv = (*_BASE_ARGV, *_TOOL_ARGS_T, *settings["args"])
+            interpreter = tuple(settings["interpreter"] or [sys.executable])
+
+        plan = settings["_dispatch_plan"] = _DispatchPlan(
+            use_path,
+            base_argv,
+            interpreter,
+            settings["workspaceFS"],
+            settings["cwd"],
+        )
+    return plan
+
+
+def _dispatch(
+    plan: _DispatchPlan,
+    argv: Sequence[str],
+    *,
+    use_stdin: bool,
+    document: workspace.Document = None,
+) -> utils.RunResult:
+    """Run argv in the mode picked by the dispatch plan.
+
+    Shared backend of _run_tool_on_document and _run_tool; the callers
+    only differ in how they assemble argv and handle results.
+    """
+    cwd = plan.cwd
+
+    if plan.use_path:
+        # This mode is used when running executables.
+        log_to_output(lambda: " ".join(argv))
+        log_to_output(lambda: f"CWD Server: {cwd}")
+        result = utils.run_path(
+            argv=argv,
+            use_stdin=use_stdin,
+            cwd=cwd,
+            source=_encoded_source(document)
+            if use_stdin and document is not None else None,
+        )
+        if result.stderr:
+            log_to_output(result.stderr)
+        return result
+
+    interpreter = plan.interpreter
+    log_to_output(lambda: " ".join([*interpreter, "-m", *argv]))
+    log_to_output(lambda: f"CWD Linter: {cwd}")
+
+    source = document.source if document is not None else None
+
+    try:
+        result = jsonrpc.run_over_json_rpc(
+            workspace=plan.code_workspace,
+            interpreter=interpreter,
+            module=TOOL_MODULE,
+            argv=argv,
+            use_stdin=use_stdin,
+            cwd=cwd,
+            source=source,
+        )
+    except Exception:
+        # Runner could not be started; run in-process instead.
+        log_error(traceback.format_exc(chain=True))
+        return _run_module_in_process(argv, use_stdin, cwd, source)
+
+    if result.exception:
+        log_error(result.exception)
+        result = utils.RunResult(result.stdout, result.stderr)
+    elif result.stderr:
+        log_to_output(result.stderr)
+    return result
+
+
 def _run_tool_on_document(
     document: workspace.Document,
     use_stdin: bool = False,
@@ -841,41 +1767,25 @@ def _run_tool_on_document(
     """
     if extra_args is None:
         extra_args = []
-    if str(document.uri).startswith("vscode-notebook-cell"):
-        # TODO: Decide on if you want to skip notebook cells.
-        # Skip notebook cells
+    if _should_skip_document(document):
+        # TODO: Decide on if you want to skip notebook cells and
+        # standard library files.
         return None
 
-    if utils.is_stdlib_file(document.path):
-        # TODO: Decide on if you want to skip standard library files.
-        # Skip standard library python files.
-        return None
+    cache_key = (
+        document.uri,
+        use_stdin,
+        tuple(extra_args),
+        hashlib.blake2b(document.source.encode(), digest_size=16).digest(),
+    )
+    cached = _RESULT_CACHE.get(cache_key)
+    if cached is not None:
+        _RESULT_CACHE.move_to_end(cache_key)
+        return cached
 
-    # deep copy here to prevent accidentally updating global settings.
-    settings = copy.deepcopy(_get_settings_by_document(document))
-
-    code_workspace = settings["workspaceFS"]
-    cwd = settings["cwd"]
-
-    use_path = False
-    use_rpc = False
-    if settings["path"]:
-        # 'path' setting takes priority over everything.
-        use_path = True
-        argv = settings["path"]
-    elif settings["interpreter"] and not utils.is_current_interpreter(
-        settings["interpreter"][0]
-    ):
-        # If there is a different interpreter set use JSON-RPC to the subprocess
-        # running under that interpreter.
-        argv = [TOOL_MODULE]
-        use_rpc = True
-    else:
-        # if the interpreter is same as the interpreter running this
-        # process then run as module.
-        argv = [TOOL_MODULE]
+    plan = _dispatch_plan(_get_settings_by_document(document))
 
-    argv += TOOL_ARGS + settings["args"] + extra_args
+    argv = [*plan.base_argv, *extra_args]
 
     if use_stdin:
         # TODO: update these to pass the appropriate arguments to provide document contents
@@ -892,171 +1802,113 @@ def _run_tool_on_document(
     else:
         argv += [document.path]
 
-    if use_path:
-        # This mode is used when running executables.
-        log_to_output(" ".join(argv))
-        log_to_output(f"CWD Server: {cwd}")
-        result = utils.run_path(
-            argv=argv,
-            use_stdin=use_stdin,
-            cwd=cwd,
-            source=document.source.replace("\r\n", "\n"),
-        )
-        if result.stderr:
-            log_to_output(result.stderr)
-    elif use_rpc:
-        # This mode is used if the interpreter running this server is different from
-        # the interpreter used for running this server.
-        log_to_output(" ".join(settings["interpreter"] + ["-m"] + argv))
-        log_to_output(f"CWD Linter: {cwd}")
+    with _log_batch():
+        result = _dispatch(plan, argv, use_stdin=use_stdin, document=document)
 
-        result = jsonrpc.run_over_json_rpc(
-            workspace=code_workspace,
-            interpreter=settings["interpreter"],
-            module=TOOL_MODULE,
-            argv=argv,
-            use_stdin=use_stdin,
-            cwd=cwd,
-            source=document.source,
-        )
-        if result.exception:
-            log_error(result.exception)
-            result = utils.RunResult(result.stdout, result.stderr)
-        elif result.stderr:
-            log_to_output(result.stderr)
-    else:
-        # In this mode the tool is run as a module in the same process as the language server.
-        log_to_output(" ".join([sys.executable, "-m"] + argv))
-        log_to_output(f"CWD Linter: {cwd}")
-        # This is needed to preserve sys.path, in cases where the tool modifies
-        # sys.path and that might not work for this scenario next time around.
-        with utils.substitute_attr(sys, "path", sys.path[:]):
-            try:
-                # TODO: `utils.run_module` is equivalent to running `python -m <pytool-module>`.
-                # If your tool supports a programmatic API then replace the function below
-                # with code for your tool. You can also use `utils.run_api` helper, which
-                # handles changing working directories, managing io streams, etc.
-                # Also update `_run_tool` function and `utils.run_module` in `lsp_runner.py`.
-                result = utils.run_module(
-                    module=TOOL_MODULE,
-                    argv=argv,
-                    use_stdin=use_stdin,
-                    cwd=cwd,
-                    source=document.source,
-                )
-            except Exception:
-                log_error(traceback.format_exc(chain=True))
-                raise
-        if result.stderr:
-            log_to_output(result.stderr)
+        log_to_output(lambda: f"{document.uri} :\r\n{result.stdout}")
+
+    _RESULT_CACHE[cache_key] = result
+    if len(_RESULT_CACHE) > _RESULT_CACHE_MAX:
+        _RESULT_CACHE.popitem(last=False)
 
-    log_to_output(f"{document.uri} :\r\n{result.stdout}")
     return result
 
 
 def _run_tool(extra_args: Sequence[str]) -> utils.RunResult:
     """Runs tool."""
-    # deep copy here to prevent accidentally updating global settings.
-    settings = copy.deepcopy(_get_settings_by_document(None))
-
-    code_workspace = settings["workspaceFS"]
-    cwd = settings["workspaceFS"]
-
-    use_path = False
-    use_rpc = False
-    if len(settings["path"]) > 0:
-        # 'path' setting takes priority over everything.
-        use_path = True
-        argv = settings["path"]
-    elif len(settings["interpreter"]) > 0 and not utils.is_current_interpreter(
-        settings["interpreter"][0]
-    ):
-        # If there is a different interpreter set use JSON-RPC to the subprocess
-        # running under that interpreter.
-        argv = [TOOL_MODULE]
-        use_rpc = True
-    else:
-        # if the interpreter is same as the interpreter running this
-        # process then run as module.
-        argv = [TOOL_MODULE]
-
-    argv += extra_args
+    settings = _get_settings_by_document(None)
+    plan = _dispatch_plan(settings)
 
-    if use_path:
-        # This mode is used when running executables.
-        log_to_output(" ".join(argv))
-        log_to_output(f"CWD Server: {cwd}")
-        result = utils.run_path(argv=argv, use_stdin=True, cwd=cwd)
-        if result.stderr:
-            log_to_output(result.stderr)
-    elif use_rpc:
-        # This mode is used if the interpreter running this server is different from
-        # the interpreter used for running this server.
-        log_to_output(" ".join(settings["interpreter"] + ["-m"] + argv))
-        log_to_output(f"CWD Linter: {cwd}")
-        result = jsonrpc.run_over_json_rpc(
-            workspace=code_workspace,
-            interpreter=settings["interpreter"],
-            module=TOOL_MODULE,
-            argv=argv,
-            use_stdin=True,
-            cwd=cwd,
-        )
-        if result.exception:
-            log_error(result.exception)
-            result = utils.RunResult(result.stdout, result.stderr)
-        elif result.stderr:
-            log_to_output(result.stderr)
+    # Unlike document runs, plain tool runs don't include TOOL_ARGS or
+    # the args setting; the caller passes the full argument list.
+    if plan.use_path:
+        argv = [*settings["path"], *extra_args]
     else:
-        # In this mode the tool is run as a module in the same process as the language server.
-        log_to_output(" ".join([sys.executable, "-m"] + argv))
-        log_to_output(f"CWD Linter: {cwd}")
-        # This is needed to preserve sys.path, in cases where the tool modifies
-        # sys.path and that might not work for this scenario next time around.
-        with utils.substitute_attr(sys, "path", sys.path[:]):
-            try:
-                # TODO: `utils.run_module` is equivalent to running `python -m <pytool-module>`.
-                # If your tool supports a programmatic API then replace the function below
-                # with code for your tool. You can also use `utils.run_api` helper, which
-                # handles changing working directories, managing io streams, etc.
-                # Also update `_run_tool_on_document` function and `utils.run_module` in `lsp_runner.py`.
-                result = utils.run_module(
-                    module=TOOL_MODULE, argv=argv, use_stdin=True, cwd=cwd
-                )
-            except Exception:
-                log_error(traceback.format_exc(chain=True))
-                raise
-        if result.stderr:
-            log_to_output(result.stderr)
+        argv = [TOOL_MODULE, *extra_args]
 
-    log_to_output(f"\r\n{result.stdout}\r\n")
+    with _log_batch():
+        result = _dispatch(plan, argv, use_stdin=True)
+
+        log_to_output(lambda: f"\r\n{result.stdout}\r\n")
     return result
 
 
 # *****************************************************
 # Logging and notification.
 # *****************************************************
+_LOG_BATCH = threading.local()
+
+
+@contextlib.contextmanager
+def _log_batch():
+    """Coalesce log_to_output calls into one show_message_log.
+
+    Each show_message_log crosses the LSP boundary as its own
+    notification; a single dispatch emits several, so batch them into
+    one multiline message per run. Nesting reuses the outer batch.
+    """
+    if getattr(_LOG_BATCH, "buffer", None) is not None:
+        yield
+        return
+    _LOG_BATCH.buffer = []
+    try:
+        yield
+    finally:
+        buffer, _LOG_BATCH.buffer = _LOG_BATCH.buffer, None
+        if buffer:
+            LSP_SERVER.show_message_log("\r\n".join(buffer), lsp.MessageType.Log)
+
+
 def log_to_output(
-    message: str, msg_type: lsp.MessageType = lsp.MessageType.Log
+    message, msg_type: lsp.MessageType = lsp.MessageType.Log
 ) -> None:
+    """Log to the output channel.
+
+    `message` may be a zero-argument callable; it is only invoked when
+    the client asked for tracing, so hot-path callers can defer the
+    string formatting behind a lambda.
+    """
+    if callable(message):
+        if LSP_SERVER.lsp.trace == lsp.TraceValues.Off:
+            return
+        message = message()
+    buffer = getattr(_LOG_BATCH, "buffer", None)
+    if buffer is not None and msg_type == lsp.MessageType.Log:
+        buffer.append(message)
+        return
     LSP_SERVER.show_message_log(message, msg_type)
 
 
+# Notification threshold from LS_SHOW_NOTIFICATION, resolved once
+# instead of re-reading the environment on every diagnostic
+_NOTIF_LEVELS = {"off": 0, "onError": 1, "onWarning": 2, "always": 3}
+_NOTIF_LEVEL = 0
+
+
+def reload_env() -> None:
+    """Re-read environment-derived logging configuration."""
+    global _NOTIF_LEVEL
+    _NOTIF_LEVEL = _NOTIF_LEVELS.get(os.getenv("LS_SHOW_NOTIFICATION", "off"), 0)
+
+
+reload_env()
+
+
 def log_error(message: str) -> None:
     LSP_SERVER.show_message_log(message, lsp.MessageType.Error)
-    if os.getenv("LS_SHOW_NOTIFICATION", "off") in ["onError", "onWarning", "always"]:
+    if _NOTIF_LEVEL >= 1:
         LSP_SERVER.show_message(message, lsp.MessageType.Error)
 
 
 def log_warning(message: str) -> None:
     LSP_SERVER.show_message_log(message, lsp.MessageType.Warning)
-    if os.getenv("LS_SHOW_NOTIFICATION", "off") in ["onWarning", "always"]:
+    if _NOTIF_LEVEL >= 2:
         LSP_SERVER.show_message(message, lsp.MessageType.Warning)
 
 
 def log_always(message: str) -> None:
     LSP_SERVER.show_message_log(message, lsp.MessageType.Info)
-    if os.getenv("LS_SHOW_NOTIFICATION", "off") in ["always"]:
+    if _NOTIF_LEVEL >= 3:
         LSP_SERVER.show_message(message, lsp.MessageType.Info)
 
 
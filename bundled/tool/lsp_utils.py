@@ -4,6 +4,7 @@
 from __future__ import annotations
 
 import contextlib
+import functools
 import io
 import os
 import os.path
@@ -18,6 +19,15 @@ from typing import Any, Callable, List, Sequence, Tuple, Union
 SERVER_CWD = os.getcwd()
 CWD_LOCK = threading.Lock()
 
+# On Linux the default 64 KiB pipe buffer forces large documents through
+# several write/read round trips per run; ask the kernel for a bigger
+# one where the interpreter supports it (F_SETPIPE_SZ, Python 3.10+).
+# 1 MiB matches the usual unprivileged fs.pipe-max-size cap.
+if sys.platform == "linux" and sys.version_info >= (3, 10):
+    PIPE_KWARGS = {"pipesize": 1024 * 1024}
+else:
+    PIPE_KWARGS = {}
+
 
 def as_list(content: Union[Any, List[Any], Tuple[Any]]) -> Union[List[Any], Tuple[Any]]:
     """Ensures we always get a list"""
@@ -42,11 +52,16 @@ def is_same_path(file_path1, file_path2) -> bool:
     )
 
 
+@functools.lru_cache(maxsize=256)
 def is_current_interpreter(executable) -> bool:
     """Returns true if the executable path is same as the current interpreter."""
     return is_same_path(executable, sys.executable)
 
 
+# These run on every diagnostics pass but their answers only change with
+# the configuration, so cache them; the server clears the caches on
+# workspace/didChangeConfiguration.
+@functools.lru_cache(maxsize=256)
 def is_stdlib_file(file_path) -> bool:
     """Return True if the file belongs to standard library."""
     return os.path.normcase(os.path.normpath(file_path)).startswith(_site_paths)
@@ -142,19 +157,28 @@ def run_module(
 
 
 def run_path(
-    argv: Sequence[str], use_stdin: bool, cwd: str, source: str = None
+    argv: Sequence[str], use_stdin: bool, cwd: str, source: Union[str, bytes] = None
 ) -> RunResult:
     """Runs as an executable."""
     if use_stdin:
+        # A bytes source is written to a binary pipe as-is; callers can
+        # pre-encode once per document instead of paying the UTF-8
+        # encode on every run.
+        binary = isinstance(source, bytes)
         with subprocess.Popen(
             argv,
-            encoding="utf-8",
+            encoding=None if binary else "utf-8",
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
             stdin=subprocess.PIPE,
             cwd=cwd,
+            **PIPE_KWARGS,
         ) as process:
-            return RunResult(*process.communicate(input=source))
+            stdout, stderr = process.communicate(input=source)
+            if binary:
+                stdout = stdout.decode("utf-8")
+                stderr = stderr.decode("utf-8")
+            return RunResult(stdout, stderr)
     else:
         result = subprocess.run(
             argv,